@@ -1,7 +1,12 @@
-from flask import Flask, render_template, flash, redirect, session, request, g
-from models import db, connect_db, Traveler, City, Country, TravelerCity
+from flask import Flask, render_template, flash, redirect, session, request, g, abort, jsonify, make_response
+from models import db, connect_db, Traveler, City, Country, WeatherObservation
 from forms import TravelerForm, LoginTravelerForm, AddCityForm, UpdateTravelerForm
+from weather import WeatherBatcher, WeatherError, fetch_weather
+from concurrent.futures import TimeoutError as WeatherTimeout
+from cache import cache, Cache, start_listener
 from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta, timezone
+import click
 import requests
 import os
 from API_Keys import WEATHER_API_KEY
@@ -15,14 +20,26 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'abcdef')
 
 TRAVELER_KEY = "current_traveler"
 
+# Weather lookups of a dashboard's cities arrive together, send them upstream as one request
+weather_batcher = WeatherBatcher(fetch_weather)
+
+# Dashboards poll every 5 minutes, upstream is only asked once per city in that time
+weather_cache = Cache(ttl=300)
+
 connect_db(app)
 
+@app.before_first_request
+def listen_for_cache_invalidations():
+    """ Evict cached travelers/countries when any app instance changes them. """
+
+    start_listener(db.engine, cache)
+
 @app.before_request
 def add_traveler_to_g():
     """ If logged in, add current traveler to Flask global. """
 
     if TRAVELER_KEY in session:
-        g.traveler = Traveler.query.get(session[TRAVELER_KEY])
+        g.traveler = Traveler.get_cached(session[TRAVELER_KEY])
 
     else:
         g.traveler = None
@@ -33,8 +50,9 @@ def home():
 
     if g.traveler:
         cities = g.traveler.cities
+        local_times = g.traveler.local_times()
         
-        return render_template("index.html", cities = cities)
+        return render_template("index.html", cities = cities, local_times = local_times)
     else:
         return redirect("/signup")
 
@@ -162,6 +180,77 @@ def verify_city_country(city, country):
     
     return False
 
+def get_current_weather(city):
+    """ Get current weather of city from https://www.weatherapi.com/docs/ and record it 
+        in city's weather history. Returns weather as dict. 
+        Aborts with JSON error if upstream has no weather for city.
+    """
+    try:
+        data = weather_cache.get_or_load(city.name, lambda: weather_batcher.get(city.name))
+
+    except WeatherError as e:
+        # 1006: No location found matching parameter 'q'
+        json_abort(str(e), 404 if e.code == 1006 else 502)
+
+    except (requests.RequestException, ValueError, LookupError, WeatherTimeout):
+        json_abort("Weather service unavailable", 502)
+
+    try:
+        weather = {
+            "temp_f": data["current"]["feelslike_f"],
+            "condition": data["current"]["condition"]["text"],
+            "icon": data["current"]["condition"]["icon"],
+            "local_time": data["location"]["localtime"]
+        }
+
+    except KeyError:
+        json_abort("Unexpected response from weather service", 502)
+
+    # Cities added before timezones were stored pick theirs up here
+    if not city.tz_id and data["location"].get("tz_id"):
+        city.set_timezone(data["location"]["tz_id"])
+
+    WeatherObservation.record(city.id, weather["temp_f"], weather["condition"], weather["local_time"])
+
+    return weather
+
+def json_abort(message, status):
+    """ Abort request with JSON error message """
+
+    abort(make_response(jsonify(error=message), status))
+
+def get_traveler_city(city_id):
+    """ City of current traveler, 401 if not logged in, 404 if traveler doesn't track it """
+
+    if not g.traveler:
+        json_abort("Login required", 401)
+
+    for city in g.traveler.cities:
+        if city.id == city_id:
+            return city
+
+    json_abort("City not found", 404)
+
+def parse_datetime_arg(name, default):
+    """ Parse ISO datetime query string argument `name` as naive UTC, like 
+        WeatherObservation.observed_at. 400 if malformed 
+    """
+
+    value = request.args.get(name)
+
+    if not value:
+        return default
+
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        json_abort(f"Invalid {name}, expected ISO datetime", 400)
+
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
 
 ############################################################
 # City/country routes
@@ -198,9 +287,18 @@ def add_city():
     city_name = request.form["city_name"]
     country_name = request.form["country_name"]
         
-    country = Country.new_country(country_name)
-    city = City.new_city(city_name, country.id)
-    g.traveler.assign_city(city)
+    try:
+        country = Country.new_country(country_name)
+        city = City.new_city(city_name, country.id)
+        g.traveler.assign_city(city)
+
+    except IntegrityError:
+        # City (or country) was garbage collected by "flask gc-orphans" mid-way, create it again
+        db.session.rollback()
+
+        country = Country.new_country(country_name)
+        city = City.new_city(city_name, country.id)
+        g.traveler.assign_city(city)
 
     flash("New city added!")
     return redirect("/")
@@ -209,18 +307,76 @@ def add_city():
 def remove_city(city_id):
     """ Remove city from current traveler's home """
 
-    city = City.query.get_or_404(city_id)
+    # Orphaned cities are cleaned up later by "flask gc-orphans"
+    if not g.traveler.unassign_city(city_id):
+        abort(404)
 
-    travelercity = TravelerCity.query.filter(TravelerCity.traveler_id == g.traveler.id, 
-                                            TravelerCity.city_id == city_id
-                                            ).first()
+    return redirect("/")
 
-    db.session.delete(travelercity)
-    db.session.commit()
+@app.route("/api/city/<int:city_id>/weather")
+def city_weather(city_id):
+    """ Current weather of one of current traveler's cities as JSON. 
+        Recorded in the city's history at most once per poll interval.
+    """
 
-    City.delete_city(city) # Only delete city if not associated with any traveler
+    city = get_traveler_city(city_id)
 
-    return redirect("/")
+    return jsonify(get_current_weather(city))
+
+@app.route("/api/city/<int:city_id>/history")
+def city_weather_history(city_id):
+    """ Recorded weather of one of current traveler's cities as JSON. Optional "start" 
+        and "end" query string arguments are ISO datetimes in UTC, defaulting to the last 7 days.
+    """
+
+    city = get_traveler_city(city_id)
+
+    end = parse_datetime_arg("end", datetime.utcnow())
+    start = parse_datetime_arg("start", end - timedelta(days=7))
+
+    observations = WeatherObservation.history(city.id, start, end)
+
+    return jsonify(city=city.name, observations=[o.serialize() for o in observations])
+
+
+############################################################
+# Maintenance commands
+
+# Names listed per table by "flask gc-orphans --dry-run"
+DRY_RUN_SAMPLE = 20
+
+@app.cli.command("gc-orphans")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows deleted per statement.")
+@click.option("--dry-run", is_flag=True, help="Only report what would be deleted.")
+def gc_orphans(batch_size, dry_run):
+    """ Delete cities no traveler tracks and countries no longer used. """
+
+    if dry_run:
+        cities = City.orphaned()
+        sample = [c.name for c in cities.with_entities(City.name).limit(DRY_RUN_SAMPLE)]
+        click.echo(f"{cities.count()} orphaned cities, e.g.: {', '.join(sample)}")
+
+        # Counts countries holding only orphaned cities, freed once those cities are deleted
+        countries = Country.orphaned()
+        sample = [c.name for c in countries.with_entities(Country.name).limit(DRY_RUN_SAMPLE)]
+        click.echo(f"{countries.count()} orphaned countries, e.g.: {', '.join(sample)}")
+        return
+
+    cities_deleted = City.delete_orphans(batch_size)
+    countries_deleted = Country.delete_orphans(batch_size)
+
+    click.echo(f"Deleted {cities_deleted} cities and {countries_deleted} countries.")
+
+@app.cli.command("downsample-weather")
+@click.option("--raw-days", default=2, show_default=True, help="Days raw observations are kept.")
+@click.option("--hourly-days", default=30, show_default=True, help="Days hourly observations are kept.")
+def downsample_weather(raw_days, hourly_days):
+    """ Roll old weather history up from raw to hourly to daily. """
+
+    hourly = WeatherObservation.downsample("raw", "hour", timedelta(days=raw_days))
+    daily = WeatherObservation.downsample("hour", "day", timedelta(days=hourly_days))
+
+    click.echo(f"Rolled up {hourly} raw and {daily} hourly observations.")
 
 
 ############################################################
@@ -244,4 +400,5 @@ def tester():
     #     else:
     #         flash("No match.")
 
-    # return render_template("test.html", form = form)
\ No newline at end of file
+    # return render_template("test.html", form = form)
+
@@ -0,0 +1,126 @@
+from time import monotonic, sleep
+import logging
+import select
+import threading
+
+CHANNEL = "cache_invalidation"
+
+logger = logging.getLogger(__name__)
+
+class Cache:
+    """ In-process cache shared by a worker's threads. Entries live for `ttl` seconds
+        unless evicted first by an invalidation published from any node.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        # Bumped on every eviction so a load racing an invalidation is never stored.
+        # `epoch` covers evictions of keys not known up front (clear, "prefix*")
+        self.versions = {}
+        self.epoch = 0
+        self.next_sweep = monotonic() + ttl
+
+    def get_or_load(self, key, load):
+        """ Return value of `key`, calling `load()` for it on a miss. """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            version = (self.epoch, self.versions.get(key, 0))
+
+        if entry and entry[1] > monotonic():
+            return entry[0]
+
+        value = load()
+
+        with self.lock:
+            if (self.epoch, self.versions.get(key, 0)) == version:
+                self.entries[key] = (value, monotonic() + self.ttl)
+
+            self.sweep()
+
+        return value
+
+    def sweep(self):
+        """ Drop expired entries, at most once per `ttl`. Caller must hold the lock. """
+
+        now = monotonic()
+
+        if now < self.next_sweep:
+            return
+
+        self.entries = {k: entry for k, entry in self.entries.items() if entry[1] > now}
+        self.next_sweep = now + self.ttl
+
+    def evict(self, key):
+        """ Evict `key`. A key ending in "*" evicts every key starting with the rest. """
+
+        with self.lock:
+            if key.endswith("*"):
+                for k in [k for k in self.entries if k.startswith(key[:-1])]:
+                    del self.entries[k]
+
+                self.epoch += 1
+
+            else:
+                self.entries.pop(key, None)
+                self.versions[key] = self.versions.get(key, 0) + 1
+
+    def clear(self):
+        """ Evict everything. """
+
+        with self.lock:
+            self.entries.clear()
+            self.epoch += 1
+
+cache = Cache()
+
+def listen(engine, cache, reconnect_delay=5, ping_interval=60):
+    """ Evict keys published on CHANNEL by any node, see models.publish_invalidation.
+        Runs forever, meant for a daemon thread.
+    """
+
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+
+    # TCP keepalives notice a LISTEN connection silently dropped by a NAT or proxy
+    cparams.update(keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+
+    while True:
+        pg = None
+
+        try:
+            pg = engine.dialect.connect(*cargs, **cparams)
+            pg.autocommit = True
+            pg.cursor().execute(f"LISTEN {CHANNEL}")
+
+            # Anything could have changed while not listening
+            cache.clear()
+
+            while True:
+                if select.select([pg], [], [], ping_interval) == ([], [], []):
+                    # Quiet channel: make sure the connection is still alive
+                    pg.cursor().execute("SELECT 1")
+                    continue
+
+                pg.poll()
+
+                while pg.notifies:
+                    cache.evict(pg.notifies.pop(0).payload)
+
+        except Exception:
+            logger.exception("Cache invalidation listener lost its connection, reconnecting")
+            cache.clear()
+
+            if pg:
+                pg.close()
+
+            sleep(reconnect_delay)
+
+def start_listener(engine, cache):
+    """ Start listening for invalidations in a daemon thread. """
+
+    thread = threading.Thread(target=listen, args=(engine, cache), daemon=True)
+    thread.start()
+
+    return thread
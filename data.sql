@@ -3,6 +3,7 @@
 
 -- \c traveler_tracker
 
+DROP TABLE IF EXISTS weather_observation;
 DROP TABLE IF EXISTS traveler_city;
 DROP TABLE IF EXISTS traveler;
 DROP TABLE IF EXISTS city;
@@ -19,7 +20,8 @@ CREATE TABLE city
 (
   id SERIAL PRIMARY KEY,
   name TEXT NOT NULL,
-  country_id INTEGER REFERENCES country(id)
+  country_id INTEGER REFERENCES country(id),
+  tz_id TEXT
 );
 
 CREATE TABLE traveler
@@ -37,4 +39,19 @@ CREATE TABLE traveler_city
   traveler_id INTEGER REFERENCES traveler(id) ON DELETE CASCADE,
   city_id INTEGER REFERENCES city(id) ON DELETE CASCADE,
   PRIMARY KEY (traveler_id, city_id)
-);
\ No newline at end of file
+);
+
+CREATE TABLE weather_observation
+(
+  id BIGSERIAL PRIMARY KEY,
+  city_id INTEGER NOT NULL REFERENCES city(id) ON DELETE CASCADE,
+  observed_at TIMESTAMP NOT NULL,
+  resolution TEXT NOT NULL DEFAULT 'raw',
+  temp_f FLOAT,
+  condition TEXT,
+  local_time TEXT
+);
+
+CREATE INDEX ix_weather_observation_city_id_observed_at ON weather_observation (city_id, observed_at);
+
+CREATE INDEX ix_weather_observation_observed_at ON weather_observation USING BRIN (observed_at);
\ No newline at end of file
@@ -1,8 +1,20 @@
 from enum import unique
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from sqlalchemy import select, exists, insert, literal, text
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.dialects.postgresql import array_agg, aggregate_order_by
+from datetime import datetime, timedelta, timezone
+from API_Keys import WEATHER_API_KEY
+from cache import cache, CHANNEL
+from weather import TIMEOUT
 import requests
 
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    from backports.zoneinfo import ZoneInfo
+
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
@@ -68,10 +80,41 @@ class Traveler(db.Model):
         travelercity = TravelerCity(city_id = city.id, traveler_id = self.id)
 
         db.session.add(travelercity)
+        publish_invalidation(f"traveler:{self.id}")
         db.session.commit()
 
         return True
 
+    def unassign_city(self, city_id):
+        """ Remove City from traveler. Only the Traveler-City link is deleted, orphaned
+            cities are left for City.delete_orphans to clean up.
+            Return False if Traveler-City relationship does not exist, otherwise return True.
+        """
+
+        deleted = TravelerCity.query.filter(TravelerCity.city_id == city_id, 
+                                            TravelerCity.traveler_id == self.id
+                                            ).delete(synchronize_session=False)
+        publish_invalidation(f"traveler:{self.id}")
+        db.session.commit()
+
+        return deleted > 0
+
+    def local_times(self):
+        """ Current local time of traveler's cities, computed from their timezone.
+            Returns dict of city id to timezone-aware datetime, cities with unknown timezone are left out.
+        """
+
+        now = datetime.now(timezone.utc)
+        local_times = {}
+
+        for city in self.cities:
+            zone = load_timezone(city.tz_id)
+
+            if zone:
+                local_times[city.id] = now.astimezone(zone)
+
+        return local_times
+
     def updateInfo(self, first_name, last_name, email, home_country):
         """ Update personal info """
         
@@ -80,6 +123,7 @@ class Traveler(db.Model):
         self.email = email
         self.home_country = home_country.id
 
+        publish_invalidation(f"traveler:{self.id}")
         db.session.commit()
 
     @classmethod
@@ -98,9 +142,21 @@ class Traveler(db.Model):
         )
 
         db.session.add(traveler)
+        db.session.flush()
+        publish_invalidation(f"traveler:{traveler.id}")
         db.session.commit()
         return traveler
 
+    @classmethod
+    def get_cached(cls, traveler_id):
+        """ Get traveler with home country and cities through the cache. Returns None if not found. """
+
+        return cached(f"traveler:{traveler_id}", 
+                      lambda session: session.query(cls)
+                                             .options(joinedload(cls.country), 
+                                                      joinedload(cls.cities).joinedload(City.country))
+                                             .get(traveler_id))
+
     @classmethod
     def authenticate(cls, email, password):
         """ Find user with `email` and `password`.
@@ -136,6 +192,10 @@ class City(db.Model):
         db.ForeignKey('country.id')
     )
 
+    tz_id = db.Column(
+        db.Text
+    )
+
     country = db.relationship('Country')
 
     def __repr__(self):
@@ -148,20 +208,59 @@ class City(db.Model):
         city = City.query.filter(City.name == city_name).one_or_none()
 
         if not city:
-            city = City(name = city_name, country_id = country_id)
+            tz_id = City.find_timezone(city_name)
+
+            city = City(name = city_name, country_id = country_id, tz_id = tz_id)
 
             db.session.add(city)
             db.session.commit()
 
         return city
 
+    def set_timezone(self, tz_id):
+        """ Store IANA timezone, evicting cached travelers tracking this city. 
+            Timezones unknown to this host are ignored.
+        """
+
+        if not load_timezone(tz_id):
+            return
+
+        self.tz_id = tz_id
+
+        for (traveler_id,) in db.session.query(TravelerCity.traveler_id).filter(TravelerCity.city_id == self.id):
+            publish_invalidation(f"traveler:{traveler_id}")
+
+        db.session.commit()
+
     @classmethod
-    def delete_city(cls, city):
-        """ Delete city only if no traveler is associated to it """
+    def find_timezone(cls, city_name):
+        """ Find IANA timezone (e.g. "America/Los_Angeles") from API. 
+            Returns timezone, or None if unavailable (backfilled later from weather).
+        """
+        try:
+            response = requests.get("http://api.weatherapi.com/v1/timezone.json", 
+                                    params={"key": WEATHER_API_KEY, "q": city_name}, timeout=TIMEOUT)
+            tz_id = response.json().get("location", {}).get("tz_id")
 
-        if not TravelerCity.query.filter(TravelerCity.city_id == city.id).all():
-            db.session.delete(city)
-            db.session.commit()
+        except (requests.RequestException, ValueError):
+            return None
+
+        return tz_id if load_timezone(tz_id) else None
+
+    @classmethod
+    def orphaned(cls):
+        """ Query of cities no traveler is associated to """
+
+        return cls.query.filter(~exists().where(TravelerCity.city_id == cls.id))
+
+    @classmethod
+    def delete_orphans(cls, batch_size=1000):
+        """ Delete cities no traveler is associated to, `batch_size` rows per DELETE.
+            Cities locked by a concurrent assign are skipped until the next run.
+            Returns number of cities deleted.
+        """
+
+        return delete_in_batches(cls, ~exists().where(TravelerCity.city_id == cls.id), batch_size)
 
 class Country(db.Model):
     """ Country class """
@@ -192,7 +291,8 @@ class Country(db.Model):
     def new_country(cls, country_name):
         """ Adds new country to system if none exists. """
 
-        country = Country.query.filter(Country.name == country_name).one_or_none()
+        country = cached(f"country:{country_name}", 
+                         lambda session: session.query(cls).filter(cls.name == country_name).one_or_none())
 
         if not country:
             currency_code = Country.find_currency_code(country_name)
@@ -200,9 +300,35 @@ class Country(db.Model):
             country = Country(name = country_name, currency_code = currency_code)
 
             db.session.add(country)
+            publish_invalidation(f"country:{country_name}")
             db.session.commit()
 
         return country
+
+    @classmethod
+    def orphaned(cls):
+        """ Query of countries left unused once orphaned cities are deleted: no city 
+            tracked by a traveler and no traveler calling it home 
+        """
+
+        tracked_cities = exists().where(City.country_id == cls.id, 
+                                        exists().where(TravelerCity.city_id == City.id))
+
+        return cls.query.filter(~tracked_cities, ~exists().where(Traveler.home_country == cls.id))
+
+    @classmethod
+    def delete_orphans(cls, batch_size=1000):
+        """ Delete countries with no cities and no traveler calling it home, 
+            `batch_size` rows per DELETE. Run after City.delete_orphans.
+            Returns number of countries deleted.
+        """
+
+        unused = db.and_(~exists().where(City.country_id == cls.id),
+                         ~exists().where(Traveler.home_country == cls.id))
+
+        # Other nodes must drop cached countries in the same commit that deletes them
+        return delete_in_batches(cls, unused, batch_size, 
+                                 on_delete=lambda: publish_invalidation("country:*"))
     
     @classmethod
     def find_currency_code(cls, country_name):
@@ -228,4 +354,207 @@ class TravelerCity(db.Model):
         db.Integer,
         db.ForeignKey('city.id', ondelete="cascade"),
         primary_key=True
-    )
\ No newline at end of file
+    )
+
+class WeatherObservation(db.Model):
+    """ Append-only weather history of a city. Raw observations are rolled up 
+        into hourly and then daily rows by WeatherObservation.downsample.
+    """
+
+    __tablename__ = "weather_observation"
+
+    # History of one city is read through the btree index. Raw rows are appended in 
+    # time order, so a BRIN index stays tiny while pruning most of the table for 
+    # downsample; rollup rows appended with older times only widen a few block ranges
+    __table_args__ = (
+        db.Index("ix_weather_observation_city_id_observed_at", "city_id", "observed_at"),
+        db.Index("ix_weather_observation_observed_at", "observed_at", postgresql_using="brin"),
+    )
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True
+    )
+
+    city_id = db.Column(
+        db.Integer,
+        db.ForeignKey('city.id', ondelete="cascade"),
+        nullable=False
+    )
+
+    observed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
+    resolution = db.Column(
+        db.Text,
+        nullable=False,
+        default="raw"
+    )
+
+    temp_f = db.Column(
+        db.Float
+    )
+
+    condition = db.Column(
+        db.Text
+    )
+
+    local_time = db.Column(
+        db.Text
+    )
+
+    def __repr__(self):
+        return f"<WeatherObservation #{self.id}: City #{self.city_id} {self.temp_f}F @ {self.observed_at} ({self.resolution})>"
+
+    def serialize(self):
+        """ Return observation as dict for JSON """
+
+        return {
+            "observed_at": self.observed_at.isoformat(),
+            "resolution": self.resolution,
+            "temp_f": self.temp_f,
+            "condition": self.condition,
+            "local_time": self.local_time
+        }
+
+    @classmethod
+    def record(cls, city_id, temp_f, condition, local_time, min_interval=timedelta(minutes=5)):
+        """ Append a raw observation for city, unless one was recorded within `min_interval`
+            (every open dashboard polls the same city). Returns observation or None if skipped.
+        """
+
+        recent = cls.query.filter(cls.city_id == city_id, 
+                                  cls.observed_at > datetime.utcnow() - min_interval).first()
+
+        if recent:
+            return None
+
+        observation = WeatherObservation(city_id = city_id, temp_f = temp_f, 
+                                         condition = condition, local_time = local_time)
+
+        db.session.add(observation)
+        db.session.commit()
+
+        return observation
+
+    @classmethod
+    def history(cls, city_id, start, end):
+        """ Observations of city between `start` and `end` (UTC), oldest first. 
+            Older parts of the range come back at hourly/daily resolution.
+        """
+
+        return (cls.query.filter(cls.observed_at >= start, 
+                                 cls.observed_at < end, 
+                                 cls.city_id == city_id)
+                         .order_by(cls.observed_at)
+                         .all())
+
+    @classmethod
+    def downsample(cls, source, target, older_than):
+        """ Roll `source` resolution rows older than `older_than` (timedelta) into one 
+            `target` resolution row per city and hour/day. Temperature is averaged, 
+            condition and local time are taken from the latest row in the bucket.
+            Returns number of `source` rows rolled up.
+        """
+
+        cutoff = truncate(datetime.utcnow() - older_than, target)
+        bucket = db.func.date_trunc(target, cls.observed_at)
+
+        def latest(column):
+            return array_agg(aggregate_order_by(column, cls.observed_at.desc()))[1]
+
+        rollup = (select(cls.city_id, bucket, literal(target), db.func.avg(cls.temp_f), 
+                         latest(cls.condition), latest(cls.local_time))
+                    .where(cls.resolution == source, cls.observed_at < cutoff)
+                    .group_by(cls.city_id, bucket))
+
+        db.session.execute(insert(cls).from_select(
+            ["city_id", "observed_at", "resolution", "temp_f", "condition", "local_time"], rollup))
+
+        rolled_up = cls.query.filter(cls.resolution == source, 
+                                     cls.observed_at < cutoff
+                                     ).delete(synchronize_session=False)
+        db.session.commit()
+
+        return rolled_up
+
+def publish_invalidation(key):
+    """ Tell every node to evict `key` from its cache. Call before commit: the notification 
+        goes out with the commit and is dropped on rollback. The local cache is evicted right away.
+    """
+
+    db.session.execute(text("SELECT pg_notify(:channel, :key)"), {"channel": CHANNEL, "key": key})
+    cache.evict(key)
+
+def cached(key, load):
+    """ Get `key` from cache, otherwise `load(session)` it in a session of its own, so 
+        the cached object is never expired by commits of a request. Returns a copy merged 
+        into the current session, or None.
+    """
+
+    def load_detached():
+        with Session(db.engine) as session:
+            return load(session)
+
+    obj = cache.get_or_load(key, load_detached)
+
+    if obj is None:
+        return None
+
+    return db.session.merge(obj, load=False)
+
+def load_timezone(tz_id):
+    """ ZoneInfo of IANA timezone, or None if empty or unknown to this host """
+
+    if not tz_id:
+        return None
+
+    try:
+        return ZoneInfo(tz_id)
+    except (KeyError, ValueError):
+        # ZoneInfoNotFoundError is a KeyError, malformed keys raise ValueError
+        return None
+
+def truncate(timestamp, unit):
+    """ Truncate datetime to start of its "hour" or "day" """
+
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+
+    if unit == "day":
+        timestamp = timestamp.replace(hour=0)
+
+    return timestamp
+
+def delete_in_batches(model, unused, batch_size, on_delete=None):
+    """ Delete `model` rows matching `unused` (e.g. a NOT EXISTS clause), `batch_size` 
+        rows at a time, until a batch comes back short. Commits after every batch, 
+        calling `on_delete()` before the commit of each batch that deleted rows.
+        Returns number of rows deleted.
+    """
+
+    total = 0
+
+    while True:
+        # Lock a batch first. Rows locked by a concurrent insert referencing them are skipped
+        ids = db.session.execute(select(model.id)
+                                    .where(unused)
+                                    .limit(batch_size)
+                                    .with_for_update(skip_locked=True)
+                                 ).scalars().all()
+
+        # Re-check in a new statement: its fresh snapshot sees references committed 
+        # after the batch was picked, which ON DELETE CASCADE would otherwise wipe out
+        if ids:
+            deleted = model.query.filter(model.id.in_(ids), unused).delete(synchronize_session=False)
+            total += deleted
+
+            if deleted and on_delete:
+                on_delete()
+
+        db.session.commit()
+
+        if len(ids) < batch_size:
+            return total
@@ -34,32 +34,65 @@ function getCurrencyCodes(cityNames) {
 }
 
 //***************************************************************************//
-// Access weather from https://www.weatherapi.com/docs/
-// Accepts JSON from external API and return object
+// Access weather through server, which fetches it from https://www.weatherapi.com/docs/
+// and records it in the city's weather history
+// Accepts JSON from server and return object
 async function getWeather(cityName) {
+    const cityId = $(`#${cityName.replace(" ", "")}`).closest(".city-block").data("city-id");
 
-    const cityInfo = await axios.get(`https://api.weatherapi.com/v1/current.json`, 
-                                    {params: {"key": WEATHER_API_KEY, 
-                                                "q": cityName}});
+    const cityInfo = await axios.get(`/api/city/${cityId}/weather`);
 
     const city = new City(cityName, 
-                        cityInfo.data.current.feelslike_f, 
-                        cityInfo.data.location.localtime,
-                        cityInfo.data.current.condition.text,
-                        cityInfo.data.current.condition.icon);
+                        cityInfo.data.temp_f, 
+                        cityInfo.data.local_time,
+                        cityInfo.data.condition,
+                        cityInfo.data.icon);
 
     return city;
 }
 
-// Update specific city weather conditions and local time in DOM
+// Update specific city weather conditions in DOM
+// Local time is shown too, for cities whose timezone the server doesn't know yet
 // "city" arguement is of class City
 function updateCityWeather(city) {
     console.log(city);
-    $(`#${city.cityName.replace(" ", '')}`).html(`<h6 class="text-center">${city.localTime}</h6>
-                                                  <h6 class="text-center">${city.weatherState}</h6>
-                                                  <img class="center-block" src=${city.weatherIcon} alt="${city.weatherState}" />
-                                                  <h3 class="text-center">${city.temp}\xB0F</h3>
-                                                  `);
+    const cityBlock = $(`#${city.cityName.replace(" ", '')}`);
+    const localTime = cityBlock.closest(".city-block").find(".local-time").length ? "" 
+                        : `<h6 class="text-center">${city.localTime}</h6>`;
+
+    cityBlock.html(`${localTime}
+                    <h6 class="text-center">${city.weatherState}</h6>
+                    <img class="center-block" src=${city.weatherIcon} alt="${city.weatherState}" />
+                    <h3 class="text-center">${city.temp}\xB0F</h3>
+                    `);
+}
+
+//***************************************************************************//
+// Local time of each city is rendered by the server along with its IANA timezone
+// Tick every local time clock in DOM from the browser's clock, DST changes included
+function updateLocalTimes() {
+    const now = new Date();
+
+    $(".local-time").each(function () {
+        let formatter;
+
+        try {
+            formatter = new Intl.DateTimeFormat("en-US", {timeZone: $(this).data("tz-id"),
+                                                          year: "numeric", month: "2-digit", day: "2-digit",
+                                                          hour: "2-digit", minute: "2-digit", hourCycle: "h23"});
+        } catch (err) {
+            // Timezone unknown to this browser, keep the server-rendered time
+            return;
+        }
+
+        const parts = {};
+
+        for (let part of formatter.formatToParts(now)) {
+            parts[part.type] = part.value;
+        }
+
+        $(this).text(`${parts.year}-${parts.month}-${parts.day} ${parts.hour}:${parts.minute}`);
+    });
 }
 
 //***************************************************************************//
@@ -75,6 +108,7 @@ async function getExchangeRates(base) {
 //***************************************************************************//
 // Code to run at the start of the home page
 // Get foreign exchange rate on every refresh of home page
+// Tick local times every second (1000 ms)
 // Update city weather info every 5 minutes (300000 ms)
 const cityNames = getCityList();
 const codes = new Set ();
@@ -93,6 +127,8 @@ getExchangeRates(base).then(function(rates) {
     }
 });
 
+const clock = setInterval(updateLocalTimes, 1000);
+
 const rep = setInterval(function () {
 
     for (let cityName of cityNames) {
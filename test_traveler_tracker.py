@@ -1,12 +1,29 @@
 from app import app, login
 from unittest import TestCase
-from models import db, connect_db, Traveler, City, Country
+from models import db, connect_db, Traveler, City, Country, WeatherObservation
+from weather import WeatherBatcher, WeatherError, fetch_weather
+from unittest import mock
+import weather
+from cache import cache, Cache, start_listener
+from datetime import datetime, timedelta, timezone
+import requests
+import threading
+import time
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///traveler_tracker_test'
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['TESTING'] = True
 app.config['WTF_CSRF_ENABLED'] = False
 
+def wait_until(condition, timeout=5):
+    """ Poll `condition` until true or `timeout` seconds pass. Returns last result. """
+    deadline = time.monotonic() + timeout
+
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    return condition()
+
 class TravelerTrackerTestCase(TestCase):
     """ Test all functions in Traveler Tracker app.py """
 
@@ -14,6 +31,7 @@ class TravelerTrackerTestCase(TestCase):
         """ Clean up any Travelers in database and adds new Traveler """
         db.drop_all()
         db.create_all()
+        cache.clear()
 
         traveler = Traveler.signup(first_name = "Mickey", 
                                     last_name = "Mouse", 
@@ -250,4 +268,292 @@ class TravelerTrackerTestCase(TestCase):
 
             self.assertEqual(res.status_code, 200)
             self.assertIn('<h2 class="page-header"> Here are your cities: </h2>',html)
-            self.assertNotIn('<div id="SanFrancisco">', html)
\ No newline at end of file
+            self.assertNotIn('<div id="SanFrancisco">', html)
+            self.assertIsNotNone(City.query.get(1))
+
+    def test_remove_city_not_tracked(self):
+        """ Test removing a city the Traveler does not track. """
+        with app.test_client() as client:
+            client.post("/login", data = {"email":"MickeyMouse@gmail.com",
+                                                 "password":"HouseOfMouse"}, 
+                                                 follow_redirects = True)
+
+            res = client.post("/city/999/remove")
+
+            self.assertEqual(res.status_code, 404)
+
+    def test_delete_orphans(self):
+        """ Test cleanup of cities and countries no Traveler uses. """
+        country = Country.new_country("Japan")
+        City.new_city("Tokyo", country.id)
+
+        self.assertEqual(City.orphaned().count(), 1)
+        self.assertEqual(Country.orphaned().count(), 1)
+        self.assertEqual(City.delete_orphans(), 1)
+        self.assertEqual(Country.delete_orphans(), 1)
+
+        self.assertIsNone(City.query.filter(City.name == "Tokyo").one_or_none())
+        self.assertIsNone(Country.query.filter(Country.name == "Japan").one_or_none())
+        self.assertIsNotNone(City.query.filter(City.name == "San Francisco").one_or_none())
+
+    def test_weather_history(self):
+        """ Test weather history of a city within a time range. """
+        old = WeatherObservation.record(1, 50.0, "Cloudy", "2022-01-01 10:00")
+        old.observed_at = datetime.utcnow() - timedelta(days=10)
+        db.session.commit()
+        WeatherObservation.record(1, 60.0, "Sunny", "2022-01-20 10:00")
+
+        with app.test_client() as client:
+            res = client.get("/api/city/1/history")
+
+            self.assertEqual(res.status_code, 401)
+
+            client.post("/login", data = {"email":"MickeyMouse@gmail.com",
+                                          "password":"HouseOfMouse"})
+
+            res = client.get("/api/city/1/history")
+            data = res.get_json()
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["city"], "San Francisco")
+            self.assertEqual([o["condition"] for o in data["observations"]], ["Sunny"])
+
+            # Offset-aware bounds are compared in UTC
+            start = (datetime.now(timezone.utc) - timedelta(hours=1)).astimezone(timezone(timedelta(hours=2)))
+            res = client.get("/api/city/1/history", query_string={"start": start.isoformat()})
+
+            self.assertEqual([o["condition"] for o in res.get_json()["observations"]], ["Sunny"])
+
+            res = client.get("/api/city/1/history?start=yesterday")
+
+            self.assertEqual(res.status_code, 400)
+            self.assertIn("error", res.get_json())
+
+            res = client.get("/api/city/999/history")
+
+            self.assertEqual(res.status_code, 404)
+
+    def test_weather_record_once_per_interval(self):
+        """ Test observations polled within the interval are recorded once. """
+        self.assertIsNotNone(WeatherObservation.record(1, 60.0, "Sunny", "2022-01-20 10:00"))
+        self.assertIsNone(WeatherObservation.record(1, 61.0, "Sunny", "2022-01-20 10:01"))
+        self.assertEqual(WeatherObservation.query.count(), 1)
+
+    def test_weather_downsample(self):
+        """ Test rolling raw weather observations up to hourly. """
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(days=3)
+
+        for minutes, temp, condition in [(5, 50.0, "Cloudy"), (35, 60.0, "Sunny")]:
+            db.session.add(WeatherObservation(city_id = 1, temp_f = temp, condition = condition, 
+                                              local_time = "2022-01-01 10:00",
+                                              observed_at = hour + timedelta(minutes=minutes)))
+        db.session.commit()
+
+        self.assertEqual(WeatherObservation.downsample("raw", "hour", timedelta(days=2)), 2)
+
+        rollup = WeatherObservation.query.one()
+
+        self.assertEqual(rollup.resolution, "hour")
+        self.assertEqual(rollup.observed_at, hour)
+        self.assertEqual(rollup.temp_f, 55.0)
+        self.assertEqual(rollup.condition, "Sunny")
+
+    def test_local_times(self):
+        """ Test local time of a Traveler's cities computed from city timezones. """
+        traveler = Traveler.query.filter(Traveler.email == "MickeyMouse@gmail.com").one()
+        city = City.query.get(1)
+        city.tz_id = "America/Los_Angeles"
+        db.session.commit()
+
+        local_times = traveler.local_times()
+
+        self.assertEqual(list(local_times), [1])
+        self.assertEqual(local_times[1].tzinfo.key, "America/Los_Angeles")
+
+        city.tz_id = None
+        db.session.commit()
+
+        self.assertEqual(traveler.local_times(), {})
+
+        # Unknown timezones are never stored, and skipped if already stored
+        city.set_timezone("Mars/Olympus_Mons")
+        self.assertIsNone(city.tz_id)
+
+        city.tz_id = "Mars/Olympus_Mons"
+        db.session.commit()
+
+        self.assertEqual(traveler.local_times(), {})
+
+    def test_cached_traveler_invalidated(self):
+        """ Test cached Traveler is evicted when its cities change. """
+        traveler = Traveler.get_cached(1)
+        self.assertEqual([c.name for c in traveler.cities], ["San Francisco"])
+
+        country = Country.new_country("Japan")
+        traveler.assign_city(City.new_city("Tokyo", country.id))
+        db.session.remove()
+
+        traveler = Traveler.get_cached(1)
+        self.assertEqual(sorted(c.name for c in traveler.cities), ["San Francisco", "Tokyo"])
+
+    def test_invalidation_across_nodes(self):
+        """ Test a committed write evicts the key from another node's cache. """
+        other_node = Cache()
+        start_listener(db.engine, other_node)
+
+        # Listener clears the cache once it is listening
+        self.assertTrue(wait_until(lambda: other_node.epoch > 0))
+
+        other_node.get_or_load("traveler:1", lambda: "Mickey")
+
+        traveler = Traveler.query.get(1)
+        traveler.updateInfo("Minnie", "Mouse", "MinnieMouse@gmail.com", traveler.country)
+
+        self.assertTrue(wait_until(lambda: "traveler:1" not in other_node.entries))
+
+class CacheTestCase(TestCase):
+    """ Test in-process cache in cache.py """
+
+    def test_evict(self):
+        """ Test evicting single keys and key prefixes. """
+        test_cache = Cache()
+        test_cache.get_or_load("traveler:1", lambda: "Mickey")
+        test_cache.get_or_load("country:Japan", lambda: "JPY")
+
+        self.assertEqual(test_cache.get_or_load("traveler:1", lambda: "Minnie"), "Mickey")
+
+        test_cache.evict("traveler:1")
+        test_cache.evict("country:*")
+
+        self.assertEqual(test_cache.get_or_load("traveler:1", lambda: "Minnie"), "Minnie")
+        self.assertEqual(test_cache.get_or_load("country:Japan", lambda: "EUR"), "EUR")
+
+    def test_expired_entries_swept(self):
+        """ Test expired entries are dropped and lookups leave no version behind. """
+        test_cache = Cache(ttl=0)
+        test_cache.get_or_load("traveler:1", lambda: "Mickey")
+
+        self.assertEqual(test_cache.entries, {})
+        self.assertEqual(test_cache.versions, {})
+
+    def test_load_racing_eviction(self):
+        """ Test value loaded while its key was evicted is not cached. """
+        test_cache = Cache()
+
+        def load():
+            test_cache.evict("traveler:1")
+            return "Mickey"
+
+        self.assertEqual(test_cache.get_or_load("traveler:1", load), "Mickey")
+        self.assertEqual(test_cache.get_or_load("traveler:1", lambda: "Minnie"), "Minnie")
+
+class WeatherBatcherTestCase(TestCase):
+    """ Test micro-batching of upstream weather lookups in weather.py """
+
+    def test_concurrent_lookups_batched(self):
+        """ Test concurrent lookups of distinct cities are sent upstream together. """
+        calls = []
+
+        def fetch(locations):
+            calls.append(sorted(locations))
+            return {location: {"location": {"name": location}} for location in locations}
+
+        batcher = WeatherBatcher(fetch, window=0.05)
+        results = {}
+
+        def lookup(city_name):
+            results[city_name] = batcher.get(city_name)
+
+        threads = [threading.Thread(target=lookup, args=(c,)) for c in ["Tokyo", "Paris", "Tokyo"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [["Paris", "Tokyo"]])
+        self.assertEqual(results["Tokyo"]["location"]["name"], "Tokyo")
+
+    def test_lookup_error(self):
+        """ Test upstream error for one location fails only its caller. """
+        def fetch(locations):
+            return {"Tokyo": {"location": {"name": "Tokyo"}}, 
+                    "abcdefgh": WeatherError({"code": 1006, "message": "No matching location found."})}
+
+        batcher = WeatherBatcher(fetch, window=0, max_batch=2)
+
+        with self.assertRaises(WeatherError) as error:
+            batcher.get("abcdefgh")
+
+        self.assertEqual(error.exception.code, 1006)
+
+    def test_missing_lookup(self):
+        """ Test lookup the upstream batch has no result for. """
+        batcher = WeatherBatcher(lambda locations: {}, window=0)
+
+        with self.assertRaises(LookupError):
+            batcher.get("abcdefgh")
+
+class FetchWeatherTestCase(TestCase):
+    """ Test upstream weather requests in weather.py, with weatherapi.com mocked """
+
+    def setUp(self):
+        weather.bulk_refused = False
+
+    def tearDown(self):
+        weather.bulk_refused = False
+
+    def mock_response(self, status_code, data):
+        return mock.Mock(status_code=status_code, ok=status_code < 400, **{"json.return_value": data})
+
+    def current(self, location):
+        return {"location": {"name": location}, "current": {"feelslike_f": 60.0}}
+
+    def test_bulk(self):
+        """ Test bulk results mapped back to locations by custom_id, errors per location. """
+        bulk = {"bulk": [{"query": {"custom_id": "1", "q": "Paris", **self.current("Paris")}},
+                         {"query": {"custom_id": "0", "q": "abcdefgh", 
+                                    "error": {"code": 1006, "message": "No matching location found."}}}]}
+
+        with mock.patch("weather.requests.post", return_value=self.mock_response(200, bulk)) as post, \
+             mock.patch("weather.requests.get") as get:
+            results = fetch_weather(["abcdefgh", "Paris"])
+
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(results["Paris"]["location"]["name"], "Paris")
+        self.assertIsInstance(results["abcdefgh"], WeatherError)
+        self.assertEqual(results["abcdefgh"].code, 1006)
+
+    def test_bulk_refused(self):
+        """ Test fallback to one request per location once bulk is refused. """
+        refused = self.mock_response(403, {"error": {"code": 2009, "message": "No access."}})
+
+        def get(url, params, timeout):
+            return self.mock_response(200, self.current(params["q"]))
+
+        with mock.patch("weather.requests.post", return_value=refused) as post, \
+             mock.patch("weather.requests.get", side_effect=get) as get:
+            results = fetch_weather(["Tokyo", "Paris"])
+            self.assertTrue(weather.bulk_refused)
+
+            fetch_weather(["Tokyo", "Paris"])
+
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(get.call_count, 4)
+        self.assertEqual(results["Tokyo"]["location"]["name"], "Tokyo")
+        self.assertEqual(results["Paris"]["location"]["name"], "Paris")
+
+    def test_bulk_failed(self):
+        """ Test fallback to one request per location when bulk request fails. """
+        def get(url, params, timeout):
+            if params["q"] == "Paris":
+                raise requests.Timeout()
+            return self.mock_response(200, self.current(params["q"]))
+
+        with mock.patch("weather.requests.post", side_effect=requests.ConnectionError()), \
+             mock.patch("weather.requests.get", side_effect=get):
+            results = fetch_weather(["Tokyo", "Paris"])
+
+        self.assertFalse(weather.bulk_refused)
+        self.assertEqual(results["Tokyo"]["location"]["name"], "Tokyo")
+        self.assertIsInstance(results["Paris"], requests.Timeout)
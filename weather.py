@@ -0,0 +1,164 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from API_Keys import WEATHER_API_KEY
+import threading
+import requests
+
+CURRENT_URL = "http://api.weatherapi.com/v1/current.json"
+
+# Seconds to wait on weatherapi.com, so a hung call can't stall a batch forever
+TIMEOUT = 5
+
+# Set once weatherapi.com refuses bulk requests for our key (paid plans only)
+bulk_refused = False
+
+# Without bulk, a batch's locations are still fetched in parallel
+fallback_pool = ThreadPoolExecutor(max_workers=8)
+
+class WeatherError(Exception):
+    """ weatherapi.com error for a location, e.g. code 1006: no location found """
+
+    def __init__(self, error):
+        super().__init__(error.get("message", "Weather service error"))
+        self.code = error.get("code")
+
+def fetch_one(location):
+    """ Current weather of one location. Returns current.json response, or the error 
+        so a failed location doesn't fail the rest of its batch.
+    """
+
+    try:
+        data = requests.get(CURRENT_URL, params={"key": WEATHER_API_KEY, "q": location}, timeout=TIMEOUT).json()
+
+    except (requests.RequestException, ValueError) as e:
+        return e
+
+    if "error" in data:
+        return WeatherError(data["error"])
+
+    return data
+
+def fetch_each(locations):
+    """ Current weather of locations, one concurrent request per location. """
+
+    return dict(zip(locations, fallback_pool.map(fetch_one, locations)))
+
+def fetch_weather(locations):
+    """ Get current weather of many locations from https://www.weatherapi.com/docs/
+        in one bulk request, or concurrent requests per location if bulk fails.
+        Returns dict of location to current.json response, or to WeatherError if 
+        upstream has no weather for it.
+    """
+    global bulk_refused
+
+    if len(locations) == 1:
+        return {locations[0]: fetch_one(locations[0])}
+
+    if bulk_refused:
+        return fetch_each(locations)
+
+    try:
+        response = requests.post(CURRENT_URL,
+                                 params={"key": WEATHER_API_KEY, "q": "bulk"},
+                                 json={"locations": [{"q": q, "custom_id": str(i)} for i, q in enumerate(locations)]},
+                                 timeout=TIMEOUT)
+
+        data = response.json() if response.ok else {}
+
+    except (requests.RequestException, ValueError):
+        return fetch_each(locations)
+
+    if "bulk" not in data:
+        # Client errors (e.g. free plan) won't go away, stop asking
+        bulk_refused = 400 <= response.status_code < 500
+
+        return fetch_each(locations)
+
+    results = {}
+
+    for item in data["bulk"]:
+        query = item["query"]
+        location = locations[int(query["custom_id"])]
+
+        results[location] = WeatherError(query["error"]) if "error" in query else query
+
+    return results
+
+class WeatherBatcher:
+    """ Collects weather lookups of concurrent callers for up to `window` seconds, or until
+        `max_batch` distinct locations are waiting, then sends them upstream as one request.
+    """
+
+    def __init__(self, fetch, window=0.01, max_batch=50):
+        self.fetch = fetch
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+
+    def get(self, location, timeout=10):
+        """ Current weather of location. Blocks until its batch is back from upstream.
+            Raises WeatherError if upstream has no weather for location, or 
+            concurrent.futures.TimeoutError after `timeout` seconds.
+        """
+
+        batch = None
+
+        with self.lock:
+            future = self.pending.get(location)
+
+            if not future:
+                future = self.pending[location] = Future()
+
+                if len(self.pending) >= self.max_batch:
+                    batch = self.take_pending()
+
+                elif not self.timer:
+                    self.timer = threading.Timer(self.window, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+        if batch:
+            self.send(batch)
+
+        return future.result(timeout)
+
+    def flush(self):
+        """ Send whatever is waiting now. """
+
+        with self.lock:
+            batch = self.take_pending()
+
+        if batch:
+            self.send(batch)
+
+    def take_pending(self):
+        """ Hand over waiting lookups and stop the window timer. Caller must hold the lock. """
+
+        batch = self.pending
+        self.pending = {}
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        return batch
+
+    def send(self, batch):
+        """ Fetch batch upstream and split results back to the waiting callers. """
+
+        try:
+            results = self.fetch(list(batch))
+
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+
+        for location, future in batch.items():
+            result = results.get(location, LookupError(f"No weather returned for {location}"))
+
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)